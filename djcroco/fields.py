@@ -1,16 +1,17 @@
 import base64
 import json
 import os
+import time
+from multiprocessing.pool import ThreadPool
 
 from django import forms, get_version
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.core.files import File
+from django.core.files.base import ContentFile
 from django.core.files.storage import Storage
-from django.core.files.temp import NamedTemporaryFile
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import signals
+from django.db.models import Q, signals
 from django.template.defaultfilters import filesizeformat
 from django.utils.translation import ugettext_lazy as _
 
@@ -20,6 +21,7 @@ else:
     from django.utils.six import string_types
 
 import crocodoc
+import requests
 from crocodoc import CrocodocError
 
 _token = 'CROCO_API_TOKEN'
@@ -31,6 +33,18 @@ if CROCO_API_TOKEN is None:
 crocodoc.api_token = CROCO_API_TOKEN
 
 
+def is_temporary_error(error):
+    """
+    Returns True for errors worth retrying later: network errors, throttling
+    and server (5xx) errors.
+    """
+    if isinstance(error, requests.RequestException):
+        return True
+    if isinstance(error, CrocodocError) and error.status_code:
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
 class CrocoStorage(Storage):
     def __init__(self):
         self._croco_uuid = None
@@ -48,11 +62,55 @@ class CrocoStorage(Storage):
 
         return uuid
 
+    def bulk_upload(self, files, workers=4, retries=2, backoff=1):
+        """
+        Uploads many files concurrently using a pool of ``workers`` threads.
+        Uploads failing with a temporary error (network errors, throttling or
+        5xx responses) are retried up to ``retries`` times, waiting
+        ``backoff`` seconds before the first retry and twice as long before
+        each next one.
+
+        Returns a list of ``(uuid, error)`` tuples in the same order as
+        ``files``, where exactly one of the two items is ``None``.
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1, got %r" % workers)
+
+        files = list(files)
+        if not files:
+            return []
+
+        pool = ThreadPool(min(workers, len(files)))
+        try:
+            return pool.map(lambda f: self._upload(f, retries, backoff), files)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _upload(self, file, retries, backoff):
+        attempt = 0
+        while True:
+            try:
+                return crocodoc.document.upload(file=file), None
+            except Exception as error:
+                # errors are returned per file so one failure does not throw
+                # away results of the whole batch
+                if attempt >= retries or not is_temporary_error(error):
+                    return None, error
+                time.sleep(backoff * 2 ** attempt)
+                attempt += 1
+                if hasattr(file, 'seek'):
+                    file.seek(0)
+
 
 class CrocoFieldObject(object):
-    def __init__(self, instance, attrs):
+    def __init__(self, instance, attrs, model_instance=None):
         self.instance = instance
         self.attrs = attrs
+        self.model_instance = model_instance
+        # JSON the attrs were loaded from, ie. what the database holds
+        self.stored_json = None
+        self._thumbnail_url = None
 
     def __getattr__(self, name):
         if name in self.attrs:
@@ -65,7 +123,9 @@ class CrocoFieldObject(object):
 
     @property
     def thumbnail(self):
-        return self.instance._get_thumbnail(self.attrs['uuid'])
+        if self._thumbnail_url is not None:
+            return self._thumbnail_url
+        return self.instance._get_thumbnail(self)
 
     @property
     def url(self):
@@ -105,6 +165,7 @@ class CrocoField(models.Field):
         self.storage = CrocoStorage()
         self.thumbnail_size = kwargs.pop('thumbnail_size', (100, 100))
         self.thumbnail_field = kwargs.pop('thumbnail_field', None)
+        self.index_text = kwargs.pop('index_text', False)
         super(CrocoField, self).__init__(*args, **kwargs)
 
     def get_internal_type(self):
@@ -116,7 +177,9 @@ class CrocoField(models.Field):
 
         try:
             if isinstance(value, string_types):
-                return CrocoFieldObject(self, json.loads(value))
+                obj = CrocoFieldObject(self, json.loads(value))
+                obj.stored_json = value
+                return obj
         except ValueError:
             raise
         return value
@@ -125,13 +188,8 @@ class CrocoField(models.Field):
         value = super(CrocoField, self).pre_save(model_instance, add)
         if value and not isinstance(value, CrocoFieldObject):
             croco_uuid = self.storage._save(value)
-            file_attrs = {
-                'name': value.name,
-                'size': value.size,
-                'uuid': croco_uuid,
-                'type': self._file_ext(value.name),
-            }
-            value = CrocoFieldObject(self, file_attrs)
+            value = CrocoFieldObject(self, self._file_attrs(value, croco_uuid),
+                model_instance)
 
             # if self.thumbnail_field:
             #     thumbnail = model_instance._meta.get_field(self.thumbnail_field)
@@ -139,10 +197,67 @@ class CrocoField(models.Field):
             #     thumbnail.storage.delete(filename)
         return self.get_prep_value(value)
 
+    def bulk_create(self, objs, workers=4, retries=2, backoff=1):
+        """
+        Uploads documents of the given (unsaved) model instances concurrently
+        and then inserts all of them with a single ``bulk_create`` call.
+
+        Instances whose upload failed are not inserted. Returns a list of
+        ``(instance, error)`` tuples in the same order as ``objs``.
+        """
+        objs = list(objs)
+        pending = [obj for obj in objs if self._needs_upload(obj)]
+        files = [getattr(obj, self.attname) for obj in pending]
+        results = dict(zip(map(id, pending),
+            self.storage.bulk_upload(files, workers, retries, backoff)))
+
+        created, outcome = [], []
+        for obj in objs:
+            croco_uuid, error = results.get(id(obj), (None, None))
+            if croco_uuid is not None:
+                value = getattr(obj, self.attname)
+                setattr(obj, self.attname, CrocoFieldObject(self,
+                    self._file_attrs(value, croco_uuid), obj))
+            if error is None:
+                created.append(obj)
+            outcome.append((obj, error))
+
+        self.model._default_manager.bulk_create(created)
+        return outcome
+
+    def text_search(self, query):
+        """
+        Returns a ``Q`` object matching rows whose indexed document text
+        contains all words of the query. No Crocodoc API calls are made.
+        """
+        from djcroco.models import CrocoDocumentText
+        documents = CrocoDocumentText.objects.search(query).filter(
+            owner=self.index_owner)
+        return Q(pk__in=documents.values('object_pk'))
+
+    @property
+    def index_owner(self):
+        """ Identifies this field in the text index, eg. `app.Model.field` """
+        opts = self.model._meta
+        return '%s.%s.%s' % (opts.app_label, opts.object_name, self.name)
+
+    def _needs_upload(self, obj):
+        value = getattr(obj, self.attname)
+        return bool(value) and not isinstance(value, CrocoFieldObject)
+
+    def _file_attrs(self, file, croco_uuid):
+        return {
+            'name': file.name,
+            'size': file.size,
+            'uuid': croco_uuid,
+            'type': self._file_ext(file.name),
+        }
+
     def contribute_to_class(self, cls, name):
         super(CrocoField, self).contribute_to_class(cls, name)
         if self.thumbnail_field:
             signals.post_init.connect(self._check_thumbnail_field, sender=cls)
+            signals.post_init.connect(self._bind_instance, sender=cls)
 
     def _check_thumbnail_field(self, instance, force=False, *args, **kwargs):
         obj = instance._meta
@@ -155,6 +270,12 @@ class CrocoField(models.Field):
             msg = "Field '{0}' must be an instance of '{1}'."
             raise AttributeError(msg.format(self.thumbnail_field, models.ImageField))
 
+    def _bind_instance(self, instance, *args, **kwargs):
+        # allows recording the saved thumbnail on the model instance
+        value = getattr(instance, self.attname)
+        if isinstance(value, CrocoFieldObject):
+            value.model_instance = instance
+
     def get_prep_value(self, value):
         if isinstance(value, CrocoFieldObject):
             return json.dumps(value.attrs)
@@ -183,13 +304,19 @@ class CrocoField(models.Field):
                 data = ''
             setattr(instance, self.name, data)
 
-    def _get_thumbnail(self, uuid):
+    def _get_thumbnail(self, value):
+        uuid = value.attrs['uuid']
         if self.thumbnail_field:
             thumbnail = self.model._meta.get_field(self.thumbnail_field)
+            filename = value.attrs.get('thumbnail')
+            if filename is not None:
+                return self._memoize_thumbnail_url(value, filename)
+
+            # thumbnails saved before their name was recorded
             filename = thumbnail.upload_to + uuid
-            # TODO: try to avoid using `exists` as it is expensive to check
             if thumbnail.storage.exists(filename):
-                return thumbnail.storage.url(filename)
+                self._record_thumbnail(value, filename)
+                return self._memoize_thumbnail_url(value, filename)
 
         try:
             status = crocodoc.document.status(uuid)
@@ -203,7 +330,7 @@ class CrocoField(models.Field):
                     if not self.thumbnail_field:
                         return "data:image/png;base64," + base64.b64encode(thumbnail)
 
-                    return self._save_thumbnail(uuid, thumbnail)
+                    return self._save_thumbnail(value, thumbnail)
                 except CrocodocError as e:
                     return e.error_message
             else:
@@ -211,19 +338,49 @@ class CrocoField(models.Field):
         except CrocodocError as e:
             return e.error_message
 
-    def _save_thumbnail(self, uuid, thumbnail):
-        # TODO: does it need to be written to temp file?
-        img_temp = NamedTemporaryFile(delete=True)
-        img_temp.write(thumbnail)
-        img_temp.seek(0)
-        img_temp.flush()
+    def _save_thumbnail(self, value, thumbnail):
+        thumbnail_field = self.model._meta.get_field(self.thumbnail_field)
+
+        filename = thumbnail_field.upload_to + value.attrs['uuid']
+        filename = thumbnail_field.storage.save(filename, ContentFile(thumbnail))
+        self._record_thumbnail(value, filename)
 
+        return self._memoize_thumbnail_url(value, filename)
+
+    def _memoize_thumbnail_url(self, value, filename):
         thumbnail_field = self.model._meta.get_field(self.thumbnail_field)
+        value._thumbnail_url = thumbnail_field.storage.url(filename)
+        return value._thumbnail_url
+
+    def _record_thumbnail(self, value, filename):
+        """
+        Stores name of the saved thumbnail in the document's attrs and in the
+        thumbnail field, so rendering does not need to check the storage.
 
-        filename = thumbnail_field.upload_to + uuid
-        thumbnail_field.storage.save(filename, File(img_temp))
+        The row is only updated while it still holds the document this value
+        was loaded from, so a render never overwrites a newer document.
+        """
+        value.attrs['thumbnail'] = filename
 
-        return thumbnail_field.storage.url(filename)
+        instance = value.model_instance
+        if instance is None or getattr(instance, self.attname) is not value:
+            return
+
+        thumbnail_field = self.model._meta.get_field(self.thumbnail_field)
+        setattr(instance, thumbnail_field.attname, filename)
+        if instance.pk is None or value.stored_json is None:
+            return
+
+        new_json = self.get_prep_value(value)
+        updated = instance.__class__._default_manager.filter(**{
+            'pk': instance.pk,
+            self.attname: value.stored_json,
+        }).update(**{
+            self.attname: new_json,
+            thumbnail_field.attname: filename,
+        })
+        if updated:
+            value.stored_json = new_json
 
     def _file_ext(self, filename):
         """ Return an extension of the file """
@@ -0,0 +1,79 @@
+import json
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import get_models
+
+import crocodoc
+
+from djcroco.fields import CrocoField, is_temporary_error
+from djcroco.models import CrocoDocumentText
+
+# number of UUIDs sent in a single status request
+STATUS_BATCH_SIZE = 100
+
+
+class Command(NoArgsCommand):
+    help = ("Downloads text of converted documents from Crocodoc and indexes"
+        " it for every CrocoField defined with `index_text=True`. Documents"
+        " whose text can not be downloaded are recorded and skipped later.")
+
+    def handle_noargs(self, **options):
+        # both indexed and failed documents are skipped
+        done = set(CrocoDocumentText.objects.values_list('uuid', flat=True))
+        documents = dict((uuid, document) for uuid, document in
+            self._get_documents().items() if uuid not in done)
+
+        uuids = sorted(documents)
+        for i in range(0, len(uuids), STATUS_BATCH_SIZE):
+            self._index(uuids[i:i + STATUS_BATCH_SIZE], documents)
+
+    def _index(self, uuids, documents):
+        try:
+            statuses = crocodoc.document.status(uuids)
+        except Exception as e:
+            self.stderr.write("Unable to get status: %s\n" % e)
+            return
+
+        for status in statuses:
+            uuid = status.get('uuid')
+            if uuid not in documents:
+                continue
+
+            owner, object_pk = documents[uuid]
+            if status.get('error') or status.get('status') == 'ERROR':
+                error = status.get('error') or 'conversion failed'
+                CrocoDocumentText.objects.fail(uuid, error, owner, object_pk)
+                self.stderr.write("%s: %s\n" % (uuid, error))
+                continue
+
+            # documents still being converted are picked up on the next run
+            if status.get('status') != 'DONE':
+                continue
+
+            try:
+                text = crocodoc.download.text(uuid)
+            except Exception as e:
+                error = getattr(e, 'error_message', None) or str(e)
+                self.stderr.write("%s: %s\n" % (uuid, error))
+                if not is_temporary_error(e):
+                    CrocoDocumentText.objects.fail(uuid, error, owner, object_pk)
+                continue
+
+            CrocoDocumentText.objects.index(uuid, text, owner, object_pk)
+            self.stdout.write("%s: indexed\n" % uuid)
+
+    def _get_documents(self):
+        """ Returns a dict of UUID -> (owner, object_pk) """
+        documents = {}
+        for model in get_models():
+            for field in model._meta.fields:
+                if not isinstance(field, CrocoField) or not field.index_text:
+                    continue
+
+                values = model._default_manager.values_list('pk',
+                    field.attname)
+                for object_pk, value in values:
+                    if value:
+                        uuid = json.loads(value)['uuid']
+                        documents[uuid] = (field.index_owner, object_pk)
+        return documents
@@ -0,0 +1,108 @@
+import base64
+import re
+import zlib
+
+from django.db import models
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+TERM_MAX_LENGTH = 64
+
+
+def tokenize(text):
+    """
+    Returns a set of lowercased words found in the given text.
+
+    Usage:
+    >>> sorted(tokenize(u'Hello, world! Hello.'))
+    [u'hello', u'world']
+    """
+    return set(term.lower()[:TERM_MAX_LENGTH] for term in TERM_RE.findall(text))
+
+
+class CrocoDocumentTextManager(models.Manager):
+    def index(self, uuid, text, owner, object_pk):
+        """
+        Stores (compressed) text of the document and indexes its words.
+        ``owner`` and ``object_pk`` identify the field and row the document
+        belongs to (see ``CrocoField.index_owner``).
+        """
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+
+        document = self._store(uuid, owner, object_pk, error='')
+        document.text = text
+        document.save()
+
+        document.terms.all().delete()
+        terms = [CrocoTextTerm(document=document, term=term)
+            for term in tokenize(text)]
+        if hasattr(CrocoTextTerm.objects, 'bulk_create'):
+            CrocoTextTerm.objects.bulk_create(terms)
+        else:  # Django 1.3
+            for term in terms:
+                term.save()
+        return document
+
+    def fail(self, uuid, error, owner, object_pk):
+        """ Records that text of the document can not be downloaded """
+        document = self._store(uuid, owner, object_pk, error=error[:255])
+        document.text = u''
+        document.save()
+        document.terms.all().delete()
+        return document
+
+    def search(self, query):
+        """ Returns documents which contain all words of the query """
+        terms = tokenize(query)
+        qs = self.get_query_set()
+        if not terms:
+            return qs.none()
+
+        for term in terms:
+            qs = qs.filter(terms__term=term)
+        return qs
+
+    def _store(self, uuid, owner, object_pk, error):
+        # a row keeps only the text of its current document
+        self.filter(owner=owner, object_pk=object_pk).exclude(uuid=uuid).delete()
+
+        document, _created = self.get_or_create(uuid=uuid, defaults={
+            'owner': owner, 'object_pk': object_pk})
+        document.owner = owner
+        document.object_pk = object_pk
+        document.error = error
+        return document
+
+
+class CrocoDocumentText(models.Model):
+    uuid = models.CharField(max_length=36, unique=True)
+    owner = models.CharField(max_length=255, db_index=True)
+    object_pk = models.PositiveIntegerField(db_index=True)
+    compressed_text = models.TextField(editable=False)
+    error = models.CharField(max_length=255, blank=True)
+
+    objects = CrocoDocumentTextManager()
+
+    def _get_text(self):
+        if not self.compressed_text:
+            return u''
+        return zlib.decompress(base64.b64decode(self.compressed_text)).decode('utf-8')
+
+    def _set_text(self, text):
+        self.compressed_text = base64.b64encode(zlib.compress(text.encode('utf-8')))
+
+    text = property(_get_text, _set_text)
+
+    def __unicode__(self):
+        return self.uuid
+
+
+class CrocoTextTerm(models.Model):
+    document = models.ForeignKey(CrocoDocumentText, related_name='terms')
+    term = models.CharField(max_length=TERM_MAX_LENGTH, db_index=True)
+
+    class Meta:
+        unique_together = ('document', 'term')
+
+    def __unicode__(self):
+        return self.term
@@ -1,3 +1,5 @@
+import tempfile
+
 from django.conf.global_settings import TEMPLATE_CONTEXT_PROCESSORS
 
 DEBUG = True
@@ -22,3 +24,6 @@ INSTALLED_APPS = (
 )
 
 ROOT_URLCONF = 'djcroco.tests.urls'
+
+# removed by the tests when they finish
+CROCO_CACHE_DIR = tempfile.mkdtemp()
@@ -5,7 +5,7 @@ from djcroco.fields import CrocoField
 
 class Example(models.Model):
     name = models.CharField(max_length=255)
-    document = CrocoField(thumbnail_field='my_thumbnail')
+    document = CrocoField(thumbnail_field='my_thumbnail', index_text=True)
     my_thumbnail = models.ImageField(upload_to='whatever/')
 
     def __unicode__(self):
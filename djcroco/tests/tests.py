@@ -1,11 +1,21 @@
+import json
+import shutil
 import time
+from StringIO import StringIO
 
+import crocodoc
+import requests
+from django import get_version
+from django.conf import settings
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.utils import unittest
 from django.template import Context, Template
 from django.test.client import Client
 
+from djcroco.models import CrocoDocumentText
 from .models import Example, NullableExample
 
 
@@ -28,6 +38,23 @@ TEST_DOC_NAME = 'test_doc_file.pdf'
 
 client = Client()
 
+# `Manager.bulk_create` was added in Django 1.4
+HAS_BULK_CREATE = get_version()[:3] != '1.3'
+
+
+class FakeResponse(object):
+    """ Response passed to `CrocodocError` to set its status code """
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = ''
+
+
+def get_content(response):
+    """ Returns body of the response, also when it is streamed (Django 1.5+) """
+    if getattr(response, 'streaming', False):
+        return ''.join(response.streaming_content)
+    return response.content
+
 
 def initial_setup():
     """ Inits all here as we do not want doing it in *every* test """
@@ -46,6 +73,11 @@ class CrocoTestCase(unittest.TestCase):
     def setUpClass(cls):
         cls.instance = initial_setup()
 
+    @classmethod
+    def tearDownClass(cls):
+        # remove PDFs cached by the download tests (see test_settings)
+        shutil.rmtree(settings.CROCO_CACHE_DIR, ignore_errors=True)
+
     def setUp(self):
         # there is a race conditions somewhere so sleep between each test
         time.sleep(1)
@@ -71,6 +103,62 @@ class CrocoTestCase(unittest.TestCase):
         instance = NullableExample.objects.create(name='Test empty')
         self.assertEqual(instance.document, None)
 
+    @unittest.skipIf(not HAS_BULK_CREATE, "bulk_create requires Django 1.4+")
+    def test_bulk_create(self):
+        # Ensure documents are uploaded and rows inserted in one go
+        field = Example._meta.get_field('document')
+        objs = [Example(name='Bulk %d' % i,
+            document=SimpleUploadedFile(TEST_DOC_NAME, TEST_DOC_DATA))
+            for i in range(3)]
+        results = field.bulk_create(objs, workers=2)
+        self.assertEqual([error for obj, error in results], [None] * 3)
+        instances = Example.objects.filter(name__startswith='Bulk ')
+        self.assertEqual(instances.count(), 3)
+        for instance in instances:
+            self.assertEqual(instance.document.name, TEST_DOC_NAME)
+            self.assertEqual(len(instance.document.uuid), 36)
+
+    def test_bulk_upload_errors(self):
+        # Ensure errors are returned per file and only temporary ones retried
+        calls = []
+        errors = {
+            'network': [requests.ConnectionError('reset'), None],
+            'invalid': [crocodoc.CrocodocError('bad_request', FakeResponse(400))],
+            'throttled': [crocodoc.CrocodocError('slow_down', FakeResponse(429))] * 3,
+            'unreadable': [IOError('no such file')],
+        }
+
+        def upload(file=None):
+            calls.append(file.name)
+            error = errors[file.name].pop(0)
+            if error is not None:
+                raise error
+            return 'uuid-' + file.name
+
+        files = [SimpleUploadedFile(name, TEST_DOC_DATA)
+            for name in ('network', 'invalid', 'throttled', 'unreadable')]
+        original_upload = crocodoc.document.upload
+        crocodoc.document.upload = upload
+        try:
+            results = Example._meta.get_field('document').storage.bulk_upload(
+                files, workers=2, retries=2, backoff=0)
+        finally:
+            crocodoc.document.upload = original_upload
+
+        self.assertEqual(results[0], ('uuid-network', None))
+        self.assertEqual([uuid for uuid, error in results[1:]], [None] * 3)
+        self.assertEqual(results[1][1].status_code, 400)
+        self.assertEqual(results[2][1].status_code, 429)
+        self.assertTrue(isinstance(results[3][1], IOError))
+        self.assertEqual(calls.count('network'), 2)
+        self.assertEqual(calls.count('invalid'), 1)
+        self.assertEqual(calls.count('throttled'), 3)
+        self.assertEqual(calls.count('unreadable'), 1)
+
+    def test_bulk_upload_invalid_workers(self):
+        storage = Example._meta.get_field('document').storage
+        self.assertRaises(ValueError, storage.bulk_upload, [], workers=0)
+
     def test_document_name(self):
         # Ensure document has correct name
         self.assertEqual(self.instance.document.name, TEST_DOC_NAME)
@@ -142,15 +230,86 @@ class CrocoTestCase(unittest.TestCase):
         # Ensure correct response
         response = client.get(document_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.content), 679)
+        self.assertEqual(len(get_content(response)), 679)
         self.assertEqual(response._headers['content-type'][1],
             'application/pdf')
 
+    def test_document_download_range(self):
+        # Ensure byte-range requests return partial content
+        document_url = self.instance.document.download_document
+        response = client.get(document_url, HTTP_RANGE='bytes=0-99')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(response.content), 100)
+        self.assertEqual(response.content, TEST_DOC_DATA[:100])
+        self.assertEqual(response._headers['content-range'][1],
+            'bytes 0-99/679')
+        self.assertEqual(response._headers['accept-ranges'][1], 'bytes')
+
+        response = client.get(document_url, HTTP_RANGE='bytes=-79')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, TEST_DOC_DATA[600:])
+
+        # Ensure unsatisfiable range is rejected
+        response = client.get(document_url, HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response._headers['content-range'][1], 'bytes */679')
+
+    def test_document_download_cached(self):
+        # Ensure the PDF is downloaded once and ranges served from the copy
+        calls = []
+
+        def document(uuid, **kwargs):
+            calls.append(uuid)
+            return TEST_DOC_DATA
+
+        url = reverse('croco_document_download', kwargs={'uuid': 'cached-doc'})
+        original = crocodoc.download.document
+        crocodoc.download.document = document
+        try:
+            response = client.get(url, HTTP_RANGE='bytes=0-9')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.content, TEST_DOC_DATA[:10])
+            # body can be read more than once, eg. by middlewares
+            self.assertEqual(response.content, TEST_DOC_DATA[:10])
+            self.assertEqual(response['Content-Encoding'], 'identity')
+            etag = response['ETag']
+
+            response = client.get(url, HTTP_RANGE='bytes=10-19')
+            self.assertEqual(response.content, TEST_DOC_DATA[10:20])
+            self.assertEqual(response['ETag'], etag)
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(get_content(response), TEST_DOC_DATA)
+        finally:
+            crocodoc.download.document = original
+        self.assertEqual(calls, ['cached-doc'])
+
+    def test_document_download_not_pdf(self):
+        # Ensure an error body returned by Crocodoc is neither served as the
+        # document nor cached
+        calls = []
+
+        def document(uuid, **kwargs):
+            calls.append(uuid)
+            return '{"error": "rate limit exceeded"}'
+
+        url = reverse('croco_document_download', kwargs={'uuid': 'not-pdf'})
+        original = crocodoc.download.document
+        crocodoc.download.document = document
+        try:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 502)
+            response = client.get(url)
+            self.assertEqual(response.status_code, 502)
+        finally:
+            crocodoc.download.document = original
+        self.assertEqual(calls, ['not-pdf', 'not-pdf'])
+
     def test_document_download_with_annotations(self):
         tmpl = "{{ obj.document.download_document|annotated:'true' }}"
         response = client.get(self.render(tmpl))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.content), 1049)
+        self.assertEqual(len(get_content(response)), 1049)
         self.assertEqual(response._headers['content-type'][1],
             'application/pdf')
 
@@ -164,6 +323,45 @@ class CrocoTestCase(unittest.TestCase):
         self.instance.document.thumbnail
         # ensure it is saved in custom thumbnail field
         self.assertTrue(self.instance.my_thumbnail.storage.exists(filename))
+        # ensure its name is recorded so rendering skips the storage check
+        self.assertEqual(self.instance.document.attrs['thumbnail'], filename)
+        instance = Example.objects.get(id=self.instance.id)
+        self.assertEqual(instance.document.attrs['thumbnail'], filename)
+        self.assertEqual(instance.my_thumbnail.name, filename)
+
+    def test_document_thumbnail_recorded_once(self):
+        # Ensure rendering a thumbnail does not overwrite a document which
+        # was replaced after the row had been loaded
+        document = {'name': TEST_DOC_NAME, 'size': 679, 'type': 'pdf'}
+        example = Example.objects.create(name='Thumbnail race',
+            document=json.dumps(dict(document, uuid='thumbnail-old')))
+        storage = example.my_thumbnail.storage
+        filename = storage.save(
+            example.my_thumbnail.field.upload_to + 'thumbnail-old',
+            ContentFile('png'))
+
+        instance = Example.objects.get(id=example.id)
+        new_json = json.dumps(dict(document, uuid='thumbnail-new'))
+        Example.objects.filter(id=example.id).update(document=new_json)
+
+        self.assertEqual(instance.document.thumbnail, storage.url(filename))
+        self.assertEqual(instance.document.attrs['thumbnail'], filename)
+        reloaded = Example.objects.get(id=example.id)
+        self.assertEqual(reloaded.document.uuid, 'thumbnail-new')
+        self.assertFalse(reloaded.my_thumbnail)
+
+        # Ensure the name is recorded when the row has not changed
+        new_filename = storage.save(
+            example.my_thumbnail.field.upload_to + 'thumbnail-new',
+            ContentFile('png'))
+        self.assertEqual(reloaded.document.thumbnail, storage.url(new_filename))
+        reloaded = Example.objects.get(id=example.id)
+        self.assertEqual(reloaded.document.attrs['thumbnail'], new_filename)
+        self.assertEqual(reloaded.my_thumbnail.name, new_filename)
+
+        storage.delete(filename)
+        storage.delete(new_filename)
+        example.delete()
 
     def test_thumbnail_download(self):
         # Ensure correct URL for `download_thumbnail`
@@ -195,3 +393,96 @@ class CrocoTestCase(unittest.TestCase):
         response = client.get(text_url)
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.content, '{"error": "text not available"}')
+
+    def test_text_search(self):
+        # Ensure indexed text is searchable without hitting Crocodoc
+        field = Example._meta.get_field('document')
+        uuid = self.instance.document.uuid
+        CrocoDocumentText.objects.index(uuid, 'Hello, world!',
+            field.index_owner, self.instance.pk)
+        self.assertEqual(CrocoDocumentText.objects.get(uuid=uuid).text,
+            u'Hello, world!')
+        found = CrocoDocumentText.objects.search('WORLD hello')
+        self.assertEqual(list(found.values_list('uuid', flat=True)), [uuid])
+        found = CrocoDocumentText.objects.search('hello moon')
+        self.assertEqual(list(found), [])
+
+        found = Example.objects.filter(field.text_search('hello'))
+        self.assertEqual(list(found), [self.instance])
+        found = Example.objects.filter(field.text_search('moon'))
+        self.assertEqual(list(found), [])
+
+        # Ensure indexed text is served by `download_text`
+        response = client.get(self.instance.document.download_text)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'Hello, world!')
+        CrocoDocumentText.objects.filter(uuid=uuid).delete()
+
+    def test_text_search_many_hits(self):
+        # Ensure search does not depend on the number of matching documents
+        # (SQLite allows at most 999 query parameters)
+        field = Example._meta.get_field('document')
+        instances = [Example.objects.create(name='Search %d' % i)
+            for i in range(1001)]
+        for i, instance in enumerate(instances):
+            CrocoDocumentText.objects.index('search-%d' % i, 'common word',
+                field.index_owner, instance.pk)
+
+        found = Example.objects.filter(field.text_search('common'))
+        self.assertEqual(found.count(), 1001)
+
+        CrocoDocumentText.objects.filter(uuid__startswith='search-').delete()
+        Example.objects.filter(name__startswith='Search ').delete()
+
+    def test_index_text_command(self):
+        # Ensure converted documents are indexed once and failures recorded
+        uuids = ('done-ok', 'done-missing', 'queued', 'failed')
+        for uuid in uuids:
+            Example.objects.create(name='Index %s' % uuid,
+                document=json.dumps({'name': TEST_DOC_NAME, 'size': 679,
+                    'uuid': uuid, 'type': 'pdf'}))
+
+        statuses = {'done-ok': 'DONE', 'done-missing': 'DONE',
+            'failed': 'ERROR'}
+        status_calls, text_calls = [], []
+
+        def status(uuids):
+            status_calls.extend(uuids)
+            return [{'uuid': uuid, 'status': statuses.get(uuid, 'QUEUED')}
+                for uuid in uuids]
+
+        def text(uuid):
+            text_calls.append(uuid)
+            if uuid == 'done-missing':
+                raise crocodoc.CrocodocError('text not available',
+                    FakeResponse(400))
+            return 'Hello, world!'
+
+        original = crocodoc.document.status, crocodoc.download.text
+        crocodoc.document.status, crocodoc.download.text = status, text
+        try:
+            call_command('croco_index_text', stdout=StringIO(),
+                stderr=StringIO())
+            self.assertEqual(sorted(text_calls), ['done-missing', 'done-ok'])
+            self.assertEqual(
+                CrocoDocumentText.objects.get(uuid='done-ok').text,
+                u'Hello, world!')
+            self.assertEqual(
+                CrocoDocumentText.objects.get(uuid='done-missing').error,
+                'text not available')
+            self.assertTrue(CrocoDocumentText.objects.get(uuid='failed').error)
+            self.assertFalse(
+                CrocoDocumentText.objects.filter(uuid='queued').exists())
+
+            # Ensure only unfinished documents are checked again
+            del status_calls[:], text_calls[:]
+            call_command('croco_index_text', stdout=StringIO(),
+                stderr=StringIO())
+            self.assertTrue('queued' in status_calls)
+            for uuid in ('done-ok', 'done-missing', 'failed'):
+                self.assertFalse(uuid in status_calls)
+            self.assertEqual(text_calls, [])
+        finally:
+            crocodoc.document.status, crocodoc.download.text = original
+            CrocoDocumentText.objects.filter(uuid__in=uuids).delete()
+            Example.objects.filter(name__startswith='Index ').delete()
@@ -1,8 +1,44 @@
+import hashlib
+import os
+import re
+import stat
+import tempfile
+import time
+from cStringIO import StringIO
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 import crocodoc
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.views.generic import View
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:  # Django < 1.5
+    StreamingHttpResponse = None
+
+from djcroco.models import CrocoDocumentText
+
+# PDFs are cached locally only when the directory is set explicitly
+CROCO_CACHE_DIR = getattr(settings, 'CROCO_CACHE_DIR', None)
+CROCO_CACHE_MAX_AGE = getattr(settings, 'CROCO_CACHE_MAX_AGE', 24 * 60 * 60)
+CROCO_CACHE_MAX_SIZE = getattr(settings, 'CROCO_CACHE_MAX_SIZE', 1024 ** 3)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class InvalidDocument(Exception):
+    """ Crocodoc returned something else than a PDF (eg. an error page) """
+    def __init__(self, content):
+        Exception.__init__(self, 'invalid_pdf')
+        self.content = content
+
 
 class CrocoDocumentView(View):
     redirect = None
@@ -48,8 +84,11 @@ class CrocoDocumentView(View):
 class CrocoDocumentDownload(View):
     """
     Downloads document from Crocodoc in PDF format.
+    Supports single byte-range requests, served from a locally cached copy.
     TODO: allow to download original version
     """
+    chunk_size = 64 * 1024
+
     def get(self, request, *args, **kwargs):
         uuid = kwargs.pop('uuid', None)
         if uuid is None:
@@ -63,17 +102,245 @@ class CrocoDocumentDownload(View):
                 annotated = True
             if 'filter' in qs_params:
                 filter_by = True
-            file = crocodoc.download.document(uuid, pdf=pdf, annotated=annotated,
-                user_filter=filter_by)
+            if annotated or filter_by or CROCO_CACHE_DIR is None:
+                # annotations change over time so these are never cached
+                file = StringIO(self._download(uuid, pdf=pdf,
+                    annotated=annotated, user_filter=filter_by))
+            else:
+                file = self._get_cached(uuid)
         except crocodoc.CrocodocError as e:
             return HttpResponse(content=e.response_content,
                 status=e.status_code)
+        except InvalidDocument as e:
+            return HttpResponse(content=e.content, status=502)
+
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        byte_range = self._parse_range(request.META.get('HTTP_RANGE'), size)
+
+        if byte_range is False:
+            file.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+
+        etag = self._etag(file, uuid, size)
+        if byte_range is None:
+            start, end, status = 0, size - 1, 200
+        else:
+            start, end = byte_range
+            status = 206
+
+        length = end - start + 1
+        if status == 200 and StreamingHttpResponse is not None:
+            response = StreamingHttpResponse(self._read(file, start, length),
+                content_type='application/pdf')
+        else:
+            # before Django 1.5 an iterator content can be read only once
+            # (eg. by middlewares), so the requested bytes are read here
+            file.seek(start)
+            content = file.read(length)
+            file.close()
+            response = HttpResponse(content, mimetype='application/pdf',
+                status=status)
 
-        response = HttpResponse(mimetype='application/pdf')
         response['Content-Disposition'] = 'attachment; filename=%s.pdf' % uuid
-        response.write(file)
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        # offsets refer to the bytes as they are, so keep GZipMiddleware and
+        # ETags computed from the partial content by CommonMiddleware away
+        response['Content-Encoding'] = 'identity'
+        response['ETag'] = etag
+        if status == 206:
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
         return response
 
+    def _etag(self, file, uuid, size):
+        if hasattr(file, 'getvalue'):
+            return '"%s"' % hashlib.md5(file.getvalue()).hexdigest()
+        # cached copy, identified by the time it was downloaded
+        mtime = os.fstat(file.fileno()).st_mtime
+        return '"%s-%d-%d"' % (uuid, size, mtime)
+
+    def _get_cached(self, uuid):
+        """
+        Returns an open file of the PDF, downloading it when it is not cached
+        or older than ``CROCO_CACHE_MAX_AGE``. Concurrent requests for the
+        same document wait for a single download.
+        """
+        cache_dir = self._get_cache_dir()
+        path = os.path.join(cache_dir, '%s.pdf' % uuid)
+        file = self._open_fresh(path)
+        if file is not None:
+            return file
+
+        lock = open(path + '.lock', 'w')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # another request may have downloaded it while we were waiting
+            file = self._open_fresh(path)
+            if file is not None:
+                return file
+
+            content = self._download(uuid, pdf=True)
+
+            # write to a temp file first so no one reads a partial copy; it
+            # is opened before the rename so pruning can not remove it first
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(content)
+            file = open(temp_path, 'rb')
+            os.rename(temp_path, path)
+            self._prune(cache_dir, keep=path)
+            return file
+        finally:
+            lock.close()
+
+    def _download(self, uuid, **kwargs):
+        # the client raises only for some error statuses, others (eg. 403 or
+        # 429) return the error body which must not be served or cached
+        content = crocodoc.download.document(uuid, **kwargs)
+        if not content.startswith('%PDF'):
+            raise InvalidDocument(content)
+        return content
+
+    def _get_cache_dir(self):
+        """
+        Creates the cache directory if needed and makes sure no other user
+        can write to it, as its files are served as they are.
+        """
+        try:
+            os.makedirs(CROCO_CACHE_DIR, stat.S_IRWXU)
+        except OSError:
+            if not os.path.isdir(CROCO_CACHE_DIR):
+                raise
+
+        info = os.stat(CROCO_CACHE_DIR)
+        owned = not hasattr(os, 'getuid') or info.st_uid == os.getuid()
+        if not owned or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ImproperlyConfigured("CROCO_CACHE_DIR '%s' must be owned by"
+                " the current user and not writable by others."
+                % CROCO_CACHE_DIR)
+        return CROCO_CACHE_DIR
+
+    def _open_fresh(self, path):
+        """
+        Returns the cached file opened for reading or None when it is missing
+        (eg. just pruned by another request) or expired.
+        """
+        try:
+            file = open(path, 'rb')
+        except IOError:
+            return None
+
+        if time.time() - os.fstat(file.fileno()).st_mtime < CROCO_CACHE_MAX_AGE:
+            return file
+        file.close()
+        return None
+
+    def _prune(self, cache_dir, keep):
+        """
+        Removes expired PDFs, then the oldest ones until the cache fits into
+        ``CROCO_CACHE_MAX_SIZE``. The file at ``keep`` is never removed.
+        """
+        files = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if not name.endswith('.pdf') or path == keep:
+                continue
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            files.append((info.st_mtime, info.st_size, path))
+
+        total = sum(size for mtime, size, path in files)
+        expired = time.time() - CROCO_CACHE_MAX_AGE
+        for mtime, size, path in sorted(files):
+            if mtime >= expired and total <= CROCO_CACHE_MAX_SIZE:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+        self._prune_locks(cache_dir)
+
+    def _prune_locks(self, cache_dir):
+        """
+        Removes lock files of documents which are not cached. A lock held by
+        another request is left alone, as removing it would let a newcomer
+        create a new lock file and download the same document again.
+        """
+        if fcntl is None:
+            return
+
+        for name in os.listdir(cache_dir):
+            if not name.endswith('.pdf.lock'):
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                lock = open(path, 'a')
+            except IOError:
+                continue
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if not os.path.exists(path[:-len('.lock')]):
+                    os.remove(path)
+            except (IOError, OSError):
+                pass
+            finally:
+                lock.close()
+
+    def _parse_range(self, header, size):
+        """
+        Returns inclusive ``(start, end)`` offsets requested by the Range header,
+        ``None`` when the whole file should be served (no header, invalid or
+        multiple ranges) or ``False`` when the range can not be satisfied.
+
+        Usage:
+        >>> view = CrocoDocumentDownload()
+        >>> view._parse_range('bytes=0-99', 1000)
+        (0, 99)
+        >>> view._parse_range('bytes=900-', 1000)
+        (900, 999)
+        >>> view._parse_range('bytes=-100', 1000)
+        (900, 999)
+        >>> view._parse_range('bytes=1000-', 1000)
+        False
+        """
+        match = RANGE_RE.match(header or '')
+        if match is None or match.groups() == ('', ''):
+            return None
+
+        start, end = match.groups()
+        if not start:
+            # suffix range, ie. the last `end` bytes
+            if int(end) == 0 or size == 0:
+                return False
+            return max(size - int(end), 0), size - 1
+
+        start = int(start)
+        end = size - 1 if not end else min(int(end), size - 1)
+        if end < start:
+            # `bytes=5-3` is invalid and ignored, `bytes=1000-` is unsatisfiable
+            return False if start >= size else None
+        return start, end
+
+    def _read(self, file, start, length):
+        try:
+            file.seek(start)
+            while length > 0:
+                chunk = file.read(min(self.chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            file.close()
+
 
 class CrocoThumbnailDownload(View):
     def get(self, request, *args, **kwargs):
@@ -103,6 +370,12 @@ class CrocoTextDownload(View):
         if uuid is None:
             raise Http404
 
+        # serve text indexed by `croco_index_text` without hitting Crocodoc
+        if 'djcroco' in settings.INSTALLED_APPS:
+            indexed = CrocoDocumentText.objects.filter(uuid=uuid, error='')[:1]
+            if indexed:
+                return HttpResponse(content=indexed[0].text)
+
         try:
             text = crocodoc.download.text(uuid)
         except crocodoc.CrocodocError as e: